@@ -1,6 +1,6 @@
-from datetime import datetime
-from time import sleep, time_ns
+from time import time_ns, localtime, strftime
 from random import random
+from math import isnan
 import numpy as np
 import matplotlib, matplotlib.pyplot as plt, matplotlib.transforms as transforms
 from matplotlib.dates import ConciseDateFormatter, DateFormatter
@@ -9,9 +9,22 @@ import sys
 from os.path import dirname, join
 from os import makedirs
 import logging
+import atexit
+import threading
 #from edwardsserial.tic import TIC
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional, only used for speeding up the emulator
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 TIC_PORT = 'COM2'
+DISPLAY_EVERY = 5  # Redraw the figure every N readings
+FIT_WINDOW = 10  # Number of recent points used for estimating the gradient
+FLUSH_EVERY = 120  # Flush log files every N readings (once a minute at 0.5 s cadence)
+EMULATE_SMOOTHING = 20  # Weight of the previous reading in the emulated pressure
+_LABEL = '{p:.1f} mbar\n({g:.1f} mbar/s)'.format_map
 
 def setup_logger():
     logger = logging.getLogger()
@@ -22,10 +35,62 @@ def setup_logger():
     logger.addHandler(consoleHandler)
     return logger
 
+_FMT = b'%04d-%02d-%02d %02d:%02d:%02d'
+_time_cache = [None, b'']  # Last formatted second and its string
+
+def format_time(t_ns):
+    """Format a timestamp in nanoseconds as b'YYYY-mm-dd HH:MM:SS.ffffff' (local time)"""
+    s, ns = divmod(t_ns, 1000000000)
+    if s != _time_cache[0]:
+        # Readings within the same second share the date and time part
+        tm = localtime(s)
+        _time_cache[:] = s, _FMT % (tm.tm_year, tm.tm_mon, tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec)
+    return b'%s.%06d' % (_time_cache[1], ns//1000)
+
+@njit(cache=True)
+def _emulate_step(tbuf, pbuf, head, t, rand_u):
+    """Store an emulated reading at index head of the buffers and return the pressure"""
+    pressure = 1050*rand_u
+    old = pbuf[head-1]  # Most recent reading, head-1 wraps around
+    if not isnan(old):
+        pressure = (pressure + EMULATE_SMOOTHING*old)/(EMULATE_SMOOTHING+1)
+    tbuf[head] = t
+    pbuf[head] = pressure
+    return pressure
+
+class SampleRing:
+    """Fixed-capacity ring of (gauge_no, t, pressure) samples for one producer and one consumer thread
+
+    The producer only writes head and the consumer only writes tail, so no locks are needed.
+    """
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.buf = np.empty((capacity, 3))
+        self.head = 0  # Total number of samples pushed
+        self.tail = 0  # Total number of samples popped
+
+    def push(self, sample):
+        """Append a sample, return False if the ring is full"""
+        if self.head - self.tail >= self.capacity:
+            return False
+        self.buf[self.head % self.capacity] = sample
+        self.head += 1  # Publish only after the sample is written
+        return True
+
+    def pop_all(self):
+        """Remove and return all pending samples, oldest first"""
+        head = self.head
+        samples = self.buf[np.arange(self.tail, head) % self.capacity]  # Copy
+        self.tail = head
+        return samples
+
+
 class TIC:
-    def __init__(self, port, gauges, memory=200, emulate=False):
-        """Setup TIC connection"""
+    def __init__(self, port, gauges, memory=200, emulate=False, interval=0.5):
+        """Setup TIC connection and start reading the gauges in a background thread"""
         self.emulate = emulate
+        self.gauges = list(gauges)
+        self.interval = interval
         if emulate is False:
             from edwardsserial.tic import TIC
             self.tic = TIC('COM2')
@@ -35,65 +100,154 @@ class TIC:
         #cursor = self.db.cursor()
         #cursor.execute('CREATE TABLE data(timestamp_ns BIGING, gauge_no INT, pressure FLOAT)')
         
-        # Make a dict of arrays, one for each gauge, for storing the most recent data
-        self.data = dict()
-        for gauge_no in gauges:
-            self.data[gauge_no] = np.full((memory, 2), np.nan)
+        # Ring buffers for storing the most recent data, one row for each gauge
+        self.memory = memory
+        self._gidx = {g: i for i, g in enumerate(self.gauges)}  # Row index of each gauge
+        self._t = np.full((len(self.gauges), memory), np.nan)
+        self._p = np.full_like(self._t, np.nan)
+        self._head = np.zeros(len(self.gauges), int)  # Index of next write
         
         # Open files for logging
         self.files = dict()
-        datestr = datetime.now().strftime('%Y-%m-%d %H-%M-%S')
+        datestr = strftime('%Y-%m-%d %H-%M-%S')
         logdir = join(dirname(__file__), 'logs')
         makedirs(logdir, exist_ok=True)
         for gauge_no in gauges:
             fname = join(logdir, f'{datestr}_gauge{gauge_no}.txt')
             logger.info(f'Opening file for logging: {fname}')
-            self.files[gauge_no] = open(fname, 'w', buffering=1)
+            self.files[gauge_no] = open(fname, 'wb', buffering=1<<16)
+        self.nwritten = dict.fromkeys(gauges, 0)
+
+        # Start acquisition thread, readings are passed to the main thread through the ring
+        self.ring = SampleRing()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._acquire_loop, name='Acquisition', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def is_running(self):
+        """Return True if the acquisition thread is alive"""
+        return self._thread.is_alive()
+
+    def close(self):
+        """Stop acquisition, flush and close log files"""
+        self._stop.set()
+        self._thread.join(timeout=5)
+        if self._thread.is_alive():
+            # Closing the files now would make the thread fail on its next write
+            logger.error('Acquisition thread did not stop, leaving log files open')
+            return
+        for f in self.files.values():
+            f.close()
+
+    def _acquire_loop(self):
+        """Read all gauges every interval and push the readings to the ring"""
+        i = 0
+        while not self._stop.is_set():
+            for g in self.gauges:
+                try:
+                    t, pressure = self.read_gauge(g, echo=(i % DISPLAY_EVERY == 0))
+                except Exception:
+                    logger.exception(f'Failed to read gauge {g}')
+                    continue
+                if not self.ring.push((g, t, pressure)):
+                    logger.warning(f'Sample ring full, dropping reading from gauge {g}')
+            i += 1
+            self._stop.wait(self.interval)
 
     def store_data(self, gauge_no, t, pressure):
-        """Store data in cache and write to file"""
-        cache = self.data[gauge_no]
-        cache = np.roll(cache, 1, axis=0)  # Shift the cache by one
-        cache[0] = (t, pressure)  # Overwrite oldest entry
-        self.data[gauge_no] = cache
-        # TODO: Write line to ascii file (one file for each gauge?)
-
-    def read_gauge(self, gauge_no):
-        """Return <DateTime> object and pressure in mbar"""
+        """Store data in cache"""
+        i = self._gidx[gauge_no]
+        head = self._head[i]
+        self._t[i, head] = t  # Overwrite oldest entry
+        self._p[i, head] = pressure
+        self._advance(i)
+
+    def _advance(self, i):
+        """Move the head of row i after an entry has been written"""
+        self._head[i] = (self._head[i]+1) % self.memory
+
+    def read_gauge(self, gauge_no, echo=True):
+        """Return timestamp in seconds and pressure in mbar, printing the reading if echo is True"""
         # Get time
-        t = 1e-9 * time_ns()
+        t_ns = time_ns()
+        t = 1e-9 * t_ns
         
         # Emulate or read from TIC
         if self.emulate:
-            pressure = 1050*random()
-            old = self.data[gauge_no][0,1]
-            if np.isfinite(old):
-                pressure = (pressure + 20*old)/21
+            i = self._gidx[gauge_no]
+            pressure = _emulate_step(self._t[i], self._p[i], self._head[i], t, random())
+            self._advance(i)
         else:
             #pressure = self.tic.gauge1.pressure * 1e-2  # mbar
             pressure = getattr(self.tic, f'gauge{gauge_no}').pressure
             if pressure is None:
-                pressure = np.nan
+                pressure = float('nan')
             else:
                 pressure *= 1e-2
-        
-        self.store_data(gauge_no, t, pressure)
+            self.store_data(gauge_no, t, pressure)
         
         # Print reading
-        datestr = datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f')
-        print(f'{gauge_no} - {datestr} - {pressure}')
+        datestr = format_time(t_ns)
+        if echo:
+            print(f'{gauge_no} - {datestr.decode()} - {pressure}')
 
         # Write to file
-        self.files[gauge_no].write(f'{datestr}    {pressure:.5e}\n')
+        self.files[gauge_no].write(b'%s    %.5e\n' % (datestr, pressure))
+        self.nwritten[gauge_no] += 1
+        if self.nwritten[gauge_no] % FLUSH_EVERY == 0:
+            self.files[gauge_no].flush()  # Limit data loss in case of a crash
 
         return t, pressure
 
 
+def linear_fit(x, y):
+    """Return slope and intercept of a least-squares line through (x, y), ignoring NaNs"""
+    ok = ~np.isnan(y)
+    x, y = x[ok], y[ok]
+    if len(x) < 2:
+        return float('nan'), float('nan')
+    # Center the data to avoid cancellation when x is large
+    xmean, ymean = x.mean(), y.mean()
+    dx = x - xmean
+    sxx = dx @ dx
+    if sxx == 0:
+        return float('nan'), float('nan')
+    slope = (dx @ (y - ymean)) / sxx
+    return slope, ymean - slope*xmean
+
+
+def lttb(x, y, n):
+    """Downsample (x, y) to n points with the Largest-Triangle-Three-Buckets algorithm"""
+    size = len(x)
+    if n >= size or n < 3:
+        return x, y
+    # The first and last points are always kept, the rest are divided into n-2 buckets
+    edges = np.linspace(1, size-1, n-1).astype(int)
+    idx = np.empty(n, int)
+    idx[0], idx[-1] = 0, size-1
+    a = 0
+    for i in range(n-2):
+        lo, hi = edges[i], edges[i+1]
+        # Average point of the next bucket (the last point for the final bucket)
+        nhi = edges[i+2] if i+2 < n-1 else size
+        cx, cy = x[hi:nhi].mean(), y[hi:nhi].mean()
+        # Select the point forming the largest triangle with the previously selected point and the average
+        area = np.abs((x[a]-cx)*(y[lo:hi]-y[a]) - (x[a]-x[lo:hi])*(cy-y[a]))
+        a = lo + np.argmax(area)
+        idx[i+1] = a
+    return x[idx], y[idx]
+
+
 class GaugeFigure():
     """Class representing the figure window"""
     
-    def __init__(self, nrows=6):
-        matplotlib.use('TkAgg')
+    def __init__(self, nrows=6, capacity=1000):
+        try:
+            matplotlib.use('QtAgg')
+        except ImportError as e:
+            logger.warning(f'Could not use QtAgg backend ({e}), falling back to the slower TkAgg backend')
+            matplotlib.use('TkAgg')
         plt.ion()  # Interactive on
         self.fig, self.axes = plt.subplots(nrows=nrows, ncols=2, sharex=True, squeeze=False, width_ratios=[2,1])
         self.fig.set_size_inches(16,12)
@@ -115,37 +269,122 @@ class GaugeFigure():
             ax.set_axis_off()
             textbox = ax.text(0, 0.5, f'[]', ha='left', va='center', fontsize=36, color='blue', transform=ax.transAxes)
             self.text.append(textbox)
+        # The changing artists are animated and drawn by blitting on top of a static background
+        self._animated = []
+        for row in range(nrows):
+            self._animated.append((self.axes[row,0], (self.series[row], self.gradients[row])))
+            self._animated.append((self.axes[row,1], (self.text[row],)))
+        for ax, artists in self._animated:
+            for artist in artists:
+                artist.set_animated(True)
+        # Backgrounds are captured after every full draw, including on resize
+        self._bgs = None
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+        self.fig.canvas.draw()
+        # Preallocate ring buffers holding the plotted data, one row per gauge
+        # Each point is written twice, at head and head+capacity, so the most recent
+        # points are always available as a contiguous view
+        self.capacity = capacity
+        self._x = np.empty((nrows, 2*capacity))
+        self._y = np.empty_like(self._x)
+        self._head = np.zeros(nrows, int)  # Index of next write
+        self._n = np.zeros(nrows, int)  # Number of points stored
+        self._coef = np.full((nrows, 2), np.nan)  # Linear fit to the most recent points
+        self._gx = np.empty((nrows, 2))  # End points of the gradient lines
+        self._gy = np.empty((nrows, 2))
+        self._tt = 0.  # Time of the most recent point
+        self._last_label = [None] * nrows  # Rounded numbers shown in the text boxes
+        self._xlim_right = -np.inf  # Right edge of the time axis
         # Define time offset, plotting relative to this
         self.t0 = 1e-9 * time_ns()
-    
-    def update_data(self, row, t, pressure, tsize=200):
-        """Dynamically add data points to existing plot"""
-        # Update plot in left column
+
+    def _unwrap(self, row):
+        """Return views of the buffered data of a row in chronological order"""
+        end = self._head[row] + self.capacity
+        start = end - self._n[row]
+        return self._x[row, start:end], self._y[row, start:end]
+
+    def push_point(self, row, t, pressure):
+        """Add a data point to the buffers and update the text in the right column"""
         tt = t-self.t0
-        #self.axes[row,0].scatter(tt.seconds, pressure, color='k', marker='.')
-        xdata, ydata = self.series[row].get_data()
-        xdata = np.hstack((xdata, (tt,)))
-        ydata = np.hstack((ydata, (pressure,)))
-        self.series[row].set_data((xdata, ydata))
-        #self.axes[row,0].plot(xdata, ydata)
-        self.axes[0,0].set_xlim(tt-tsize, tt)
-        # Recompute data limits and update view limits
-        #self.axes[row,0].relim()
-        #self.axes[row,0].autoscale_view()
-        # Estimate gradient
-        coef = np.polyfit(xdata[-10:], ydata[-10:], 1)
-        gradient = coef[0]
-        tmpx = np.array([xdata[-1]-tsize/4, xdata[-1]])
-        self.gradients[row].set_data(tmpx, np.poly1d(coef)(tmpx))
-        # Write numbers in right column
-        self.text[row].set_text(f'{pressure:.1f} mbar\n({gradient:.1f} mbar/s)')
+        head = self._head[row]
+        self._x[row, head] = self._x[row, head+self.capacity] = tt
+        self._y[row, head] = self._y[row, head+self.capacity] = pressure
+        self._head[row] = (head+1) % self.capacity
+        self._n[row] = min(self._n[row]+1, self.capacity)
+        self._tt = tt
+        # Estimate gradient from the most recent points
+        xdata, ydata = self._unwrap(row)
+        self._coef[row] = linear_fit(xdata[-FIT_WINDOW:], ydata[-FIT_WINDOW:])
+        gradient = self._coef[row, 0]
+        # Write numbers in right column, only if the displayed digits have changed
+        # NaN never compares equal, so it is replaced by None
+        label = (None if isnan(pressure) else round(pressure, 1),
+                 None if isnan(gradient) else round(gradient, 1))
+        if label != self._last_label[row]:
+            self._last_label[row] = label
+            self.text[row].set_text(_LABEL({'p': pressure, 'g': gradient}))
+
+    def redraw(self, tsize=200):
+        """Update the plotted lines from the buffers and redraw the figure"""
+        if self._tt > self._xlim_right:
+            # Scroll the time axis in steps of 5% of the window, so the background changes rarely
+            self._xlim_right = self._tt + tsize/20
+            self.axes[0,0].set_xlim(self._xlim_right-tsize, self._xlim_right)
+            self._bgs = None  # Ticks have moved, background must be redrawn
+        xmin, xmax = self.axes[0,0].get_xlim()
+        for row, series in enumerate(self.series):
+            if self._n[row] == 0:
+                continue
+            xdata, ydata = self._unwrap(row)
+            # Only plot the visible points, including one on each side so lines reach the edges
+            lo = max(np.searchsorted(xdata, xmin) - 1, 0)
+            hi = np.searchsorted(xdata, xmax) + 1
+            xvis, yvis = xdata[lo:hi], ydata[lo:hi]
+            # No point in drawing many more points than there are pixels
+            npix = int(self.axes[row,0].bbox.width)
+            if len(xvis) > 2*npix:
+                series.set_data(*lttb(xvis, yvis, npix))
+            else:
+                series.set_data(xvis, yvis)
+            # Draw gradient
+            slope, intercept = self._coef[row]
+            tmpx, tmpy = self._gx[row], self._gy[row]
+            tmpx[0] = xdata[-1]-tsize/4
+            tmpx[1] = xdata[-1]
+            tmpy[0] = slope*tmpx[0] + intercept
+            tmpy[1] = slope*tmpx[1] + intercept
+            self.gradients[row].set_data(tmpx, tmpy)
+        self.flush()
+
+    def _on_draw(self, event):
+        """Capture the static backgrounds and draw the animated artists on top"""
+        canvas = self.fig.canvas
+        self._bgs = [canvas.copy_from_bbox(ax.bbox) for ax, artists in self._animated]
+        self._draw_animated()
+
+    def _draw_animated(self):
+        """Draw the animated artists onto the canvas"""
+        for ax, artists in self._animated:
+            for artist in artists:
+                ax.draw_artist(artist)
 
     def flush(self):
         """Redraw figure with updated data"""
-        #logger.info('Start draw')
-        self.fig.canvas.draw()
+        canvas = self.fig.canvas
+        if self._bgs is None:
+            # Background is stale, do a full draw (recaptures backgrounds)
+            #logger.info('Start draw')
+            canvas.draw()
+        else:
+            # Repaint only the animated artists on top of the cached backgrounds
+            for (ax, artists), bg in zip(self._animated, self._bgs):
+                canvas.restore_region(bg)
+                for artist in artists:
+                    ax.draw_artist(artist)
+                canvas.blit(ax.bbox)
         #logger.info('Start flush')
-        self.fig.canvas.flush_events()
+        canvas.flush_events()
         #logger.info('Flush done!')
 
 
@@ -161,12 +400,16 @@ def run():
     # Initialize connection to TIC
     tic = TIC(TIC_PORT, gauges)
 
+    i = 0
     while True:
-        for g in gauges:
-            t, pressure = tic.read_gauge(g)
-            fig.update_data(g-1, t, pressure)
-        fig.flush()
-        sleep(0.5)
+        if not tic.is_running():
+            raise RuntimeError('Acquisition thread has stopped')
+        for g, t, pressure in tic.ring.pop_all():
+            fig.push_point(int(g)-1, t, pressure)
+        if i % DISPLAY_EVERY == 0:
+            fig.redraw()
+        i += 1
+        fig.fig.canvas.start_event_loop(0.5)  # Keep the window responsive between redraws
 
 
 if __name__ == '__main__':
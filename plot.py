@@ -9,8 +9,8 @@ def plot_files(filenames):
     fig, ax = plt.subplots()
     
     for f in filenames:
-        data = pd.read_csv(f, delim_whitespace=True, names=('date', 'time', 'pressure'))
-        data['datetime'] = pd.to_datetime(data.date + ' ' + data.time)
+        data = pd.read_csv(f, sep=r'\s+', names=('date', 'time', 'pressure'), dtype={'pressure': 'float64'})
+        data['datetime'] = pd.to_datetime(data.date + ' ' + data.time, format='%Y-%m-%d %H:%M:%S.%f', cache=True)
         ax.plot(data.datetime, data.pressure, '.-')
     
     # Decorate axes